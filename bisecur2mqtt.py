@@ -1,14 +1,25 @@
 import os
+import atexit
 import re
 import sys
 import logging as log
+from logging.handlers import QueueHandler, QueueListener
 import paho.mqtt.client as paho
 import time
-from datetime import datetime
+import random
 import socket
 import json, ast
 import traceback
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
+try:
+    import orjson
+except ImportError:  # optional, falls back to the stdlib json module
+    orjson = None
 import threading
+import queue
 
 from pysecur3.client import MCPClient
 from pysecur3.MCP import MCPSetState
@@ -16,13 +27,13 @@ from pysecur3.MCP import MCPSetState
 VERSION = "0.7.3"
 DEBUG = False
 
-CONFIG = os.getenv('BISECUR2MQTT_CONFIG', 'bisecur2mqtt.conf')
+CONFIG = os.getenv('BISECUR2MQTT_CONFIG', 'bisecur2mqtt.toml')
 
 
 class Config(object):
     def __init__(self, filename=CONFIG):
-        self.config = {}
-        exec(compile(open(filename, "rb").read(), filename, 'exec'), self.config)
+        with open(filename, "rb") as f:
+            self.config = tomllib.load(f)
 
     def get(self, key, default=None):
         return self.config.get(key, default)
@@ -35,92 +46,155 @@ except Exception as e:
     sys.exit(2)
 
 MQTT_TOPIC_BASE = config.get("mqtt_topic_base", "bisecur2mqtt")
+HA_TOPIC = config.get("mqtt_topic_HA_discovery", "homeassistant")
 MQTT_COMMAND_SUBTOPIC = "send_command"
-MQTT_QOS = 0
+MQTT_QOS = 1
+MQTT_SUB_QOS = 0  # door commands must not be queued by the broker and replayed after a reconnect
+MQTT_AVAILABILITY_QOS = 0  # QoS 1 would queue 'offline' while disconnected and replay it after 'online'
+MQTT_MAX_INFLIGHT = 20
+MQTT_MAX_QUEUED = 1000
 
 DOORS_PORT = [0, 1]
-
-MQTT_CLIENT_SUB = None
-MQTT_CLIENT_PUB = None
+_MCP_SET_STATE = {port: MCPSetState.construct(port) for port in DOORS_PORT}
+
+BISECUR_USER = config.get("bisecur_user")
+BISECUR_PW = config.get("bisecur_pw")
+BISECUR_IP = config.get("bisecur_ip", None)
+BISECUR_MAC = config.get("bisecur_mac", "").replace(':', '')
+SRC_MAC = config.get("src_mac", "FF:FF:FF:FF:FF:FF").replace(':', '')
+
+COMMAND_TOPIC = f"{MQTT_TOPIC_BASE}/{MQTT_COMMAND_SUBTOPIC}/command"
+COMMAND_TS_TOPIC = f"{COMMAND_TOPIC}_ts"
+ERROR_TOPIC = f"{MQTT_TOPIC_BASE}/{MQTT_COMMAND_SUBTOPIC}/error"
+RESPONSE_TOPIC = {d: f"{MQTT_TOPIC_BASE}/{MQTT_COMMAND_SUBTOPIC}/{d}/response" for d in DOORS_PORT}
+DOOR_TOPIC = {d: f"{MQTT_TOPIC_BASE}/garage_door/{d}" for d in DOORS_PORT}
+AVAILABILITY_TOPIC = {d: f"{MQTT_TOPIC_BASE}/{d}/state" for d in DOORS_PORT}
+ATTRIBUTES_TOPIC = {d: f"{MQTT_TOPIC_BASE}/{d}/attributes" for d in DOORS_PORT}
+HA_CONFIG_TOPIC = {d: f"{HA_TOPIC}/cover/bisecur/{d}/config" for d in DOORS_PORT}
+
+# Home Assistant 'cover' discovery config; the per-door topics are filled in by init_ha_discovery()
+HA_DISCOVERY_PAYLOAD = {
+    "door_commands_list": ["impulse", "up", "down", "partial", "stop", "light"],
+    "name": "Bisecur Gateway: Garage Door",
+    "schema": "state",
+    "supported_features": ["impulse", "up", "down", "partial", "stop", "light", "get_door_state",
+                           "get_ports", "login", "sys_reset"],
+    "payload_available": "online",
+    "payload_not_available": "offline", "unique_id": "bs_garage_door", "device_class": "garage",
+    "payload_close": "down", "payload_open": "up", "payload_stop": "impulse", "position_open": 100.0,
+    "position_closed": 0.0,
+    "position_template": "{{ value_json.value.position }}",
+    "value_template": "{{ value_json.value.state }}",
+    "command_topic": COMMAND_TOPIC,
+    "connections": ["mac", BISECUR_MAC, "ip", BISECUR_IP],
+    "sw_version": VERSION,
+}
+
+MQTT_CLIENT = None
+SHUTDOWN_EVENT = threading.Event()
+EXIT_CODE = 0
 
 CLI = None
-LAST_DOOR_STATE = None
-POS_TRACKING_THREAD = None
-DO_EXIT_THREAD = False
+ERROR_PUBLISHED = True  # whether the error topic may hold an error that still needs clearing
+CLI_LOCK = threading.RLock()  # MCPClient shares one socket and last_error between callers
+LAST_DOOR_STATES = {}
+POLLER_THREAD = None
+POLLER_WAKE = threading.Event()
+POLL_INTERVAL = 2
+MAX_STALLED_POLLS = 5
+TRACKED_DOORS = {}
+TRACKED_DOORS_LOCK = threading.Lock()
+CMD_QUEUE = queue.Queue()
+CMD_WORKER_THREAD = None
 
 MAX_RETRIES = 10
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 60
 
 CMD_GET_TYPE = 49
 CMD_GET_STATE = 50
 CMD_SET_STATE = 51
 
+_GET_STATE_CMDS = frozenset({"get_door_state", "get_door_position"})
+_DOOR_ACTIONS = frozenset({"up", "down", "open", "close", "stop", "impulse", "partial", "light"})
+_SET_STATE_ACTIONS = frozenset({"impulse", "up", "down", "partial", "light", "stop"})
+_UP_ACTIONS = frozenset({"up", "open"})
+_DOWN_ACTIONS = frozenset({"down", "close"})
+_CMD_RE = re.compile(r"^([a-zA-Z_]+)_(\d+)$")
+
+TS_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
 LOGFILE = config.get('logfile', 'bisecur2mqtt.log')
 LOGFORMAT = "%(asctime)10s [%(filename)s:%(lineno)3s]  %(message)s [%(funcName)s()]"
 
+# Callers only enqueue log records; formatting and file/stderr I/O happen on the listener thread
+LOG_QUEUE = queue.Queue(-1)
+fileLogger = log.FileHandler(LOGFILE)
+fileLogger.setFormatter(log.Formatter(LOGFORMAT))
+stderrLogger = log.StreamHandler()
+stderrLogger.setFormatter(log.Formatter(LOGFORMAT))
+LOG_LISTENER = QueueListener(LOG_QUEUE, fileLogger, stderrLogger)
+
+log.getLogger().addHandler(QueueHandler(LOG_QUEUE))
 if DEBUG:
-    log.basicConfig(filename=LOGFILE, level=log.DEBUG, format=LOGFORMAT)
+    log.getLogger().setLevel(log.DEBUG)
 else:
-    log.basicConfig(filename=LOGFILE, level=log.INFO, format=LOGFORMAT)
+    log.getLogger().setLevel(log.INFO)
 
-stderrLogger = log.StreamHandler()
-stderrLogger.setFormatter(log.Formatter(LOGFORMAT))
-log.getLogger().addHandler(stderrLogger)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)  # flush queued records on every exit path, including sys.exit(2)
 log.info("Starting")
 log.debug("DEBUG MODE")
 
 
+def json_dumps(obj):
+    # Serialise an outgoing MQTT payload; orjson returns bytes, which paho publishes as-is
+    if orjson:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, default=str)
+
+
 def do_command(cmd, set_door=None):
     cmd = cmd.lower().strip()
-    publish_to_mqtt(f"{MQTT_COMMAND_SUBTOPIC}/command", datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), ts_only=True)
+    publish_to_mqtt(COMMAND_TS_TOPIC, None, ts_only=True)
     resp = None
     try:
-        if cmd in "get_door_state get_door_position":
+        if cmd in _GET_STATE_CMDS:
             resp, _, _ = get_door_status(set_door)
 
-        elif cmd in "up down open close stop impulse partial light":
+        elif cmd in _DOOR_ACTIONS:
             sanitised_cmd = cmd.replace("open", "up").replace("close", "down")
             resp = do_door_action(sanitised_cmd, set_door)
 
-        elif cmd == "get_ports":
-            resp = get_ports()
-
-        elif cmd in "get_version get_gw_version":
-            resp = get_gw_version()
-
-        elif cmd == "login":
-            resp = do_gw_login()
-
-        elif cmd in "sys_restart init_bisecur_gw":
-            resp = init_bisecur_gw(True)
-
         else:
-            resp = f"Command '{cmd} is not recognised"
+            handler = _DISPATCH.get(cmd)
+            resp = handler() if handler else f"Command '{cmd} is not recognised"
         check_mcp_error(resp)
-        publish_to_mqtt(f"{MQTT_COMMAND_SUBTOPIC}/{set_door}/response", resp)
+        publish_to_mqtt(RESPONSE_TOPIC[set_door], resp)
     except Exception as ex:
         log.error(ex)
         traceback.print_exc()
         check_mcp_error(resp)
 
 
-def publish_to_mqtt(topic, payload, topic_base=MQTT_TOPIC_BASE, qos=MQTT_QOS, retain=False, ts_only=False):
-    if MQTT_CLIENT_SUB:
-        if not isinstance(payload, str):
-            payload = str(payload)
+def publish_to_mqtt(topic, payload, qos=MQTT_QOS, retain=False, ts_only=False, with_ts=True):
+    if MQTT_CLIENT:
         try:
-            if not ts_only:
-                log.debug(f"---> MQTT pub: {topic_base}/{topic} {payload}")
-                MQTT_CLIENT_SUB.publish(f"{topic_base}/{topic}", payload, qos=qos, retain=retain)
-
-            log.debug(f"---> MQTT pub: {topic_base}/{topic}_ts {datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}")
-            MQTT_CLIENT_SUB.publish(f"{topic_base}/{topic}_ts", datetime.now().strftime("%Y-%m-%dT%H:%M:%S"), qos=qos,
-                                    retain=retain)
+            ts = time.strftime(TS_FORMAT, time.localtime())
+            if ts_only:
+                payload = ts
+            elif with_ts:
+                payload = json_dumps({"value": payload, "ts": ts})
+            elif not isinstance(payload, (str, bytes)):
+                payload = str(payload)
+            log.debug(f"---> MQTT pub: {topic} {payload}")
+            MQTT_CLIENT.publish(topic, payload, qos=qos, retain=retain)
         except Exception as ex:
             log.error(f"Error in topic: {topic}, payload: {payload}")
             log.error(ex)
 
     else:
-        log.warning(f"Ignoring publish to broker as 'MQTT_CLIENT_PUB' not initalised ({topic} {payload})")
+        log.warning(f"Ignoring publish to broker as 'MQTT_CLIENT' not initalised ({topic} {payload})")
 
 
 def get_gw_version():
@@ -128,7 +202,7 @@ def get_gw_version():
         resp = CLI.get_gw_version()
         version = resp.payload.command.gw_version
         log.info(f"Gateway HW Version: {version}")
-        publish_to_mqtt("attributes/gw_hw_version", version)
+        publish_to_mqtt(f"{MQTT_TOPIC_BASE}/attributes/gw_hw_version", version)
         return resp, version
 
     except Exception as ex:
@@ -140,11 +214,16 @@ def get_ports():
     cmd_mcp = {"CMD": "GET_GROUPS", "FORUSER": 0}
     try:
         resp = CLI.jcmp(cmd_mcp)
-        ports = resp.payload.payload
-        ports = ast.literal_eval(ports.decode("utf-8"))  # convert from binary
+        raw_ports = resp.payload.payload
+        try:
+            ports = json.loads(raw_ports)
+        except ValueError:
+            # Older gateway firmware may answer with a Python-style repr (single quotes)
+            ports = ast.literal_eval(raw_ports.decode("utf-8"))
+            raw_ports = json_dumps(ports)
 
         log.info(f"Ports for user 0: {json.dumps(ports, indent=4, sort_keys=True)}")
-        publish_to_mqtt("attributes/user0_ports", json.dumps(ports))
+        publish_to_mqtt(f"{MQTT_TOPIC_BASE}/attributes/user0_ports", raw_ports, with_ts=False)
 
         return resp, ports
     except Exception as ex:
@@ -152,6 +231,11 @@ def get_ports():
         traceback.print_exc()
 
 
+def backoff_delay(retries, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    # Exponential backoff with full jitter, so that retries from several instances do not line up
+    return random.uniform(0, min(cap, base * 2 ** retries))
+
+
 def check_broken_pipe(err_msg):
     if "errno 32" in err_msg or "broken pipe" in err_msg:
         log.error("ERROR: Restarting due to broken pipe")
@@ -161,7 +245,15 @@ def check_broken_pipe(err_msg):
         return False
 
 
-def get_door_status(set_door):
+def door_payload(position, state):
+    # Leave 'state' out when unknown so HA's value_template does not render a retained 'None'
+    payload = {"position": position}
+    if state:
+        payload["state"] = state
+    return payload
+
+
+def get_door_status(set_door, publish=True):
     set_door = int(set_door)
     retries = 0
     while retries < MAX_RETRIES:
@@ -181,10 +273,9 @@ def get_door_status(set_door):
             else:
                 position = -1
                 log.warning(f"get_transition response has no 'percentage_open' attribute (resp: {resp})")
-            log.info(f"posting position {position} and state {state} to MQTT....")
-            publish_to_mqtt(f"garage_door/{set_door}/position", position)
-            if state:
-                publish_to_mqtt(f"garage_door/{set_door}/state", state)
+            if publish:
+                log.info(f"posting position {position} and state {state} to MQTT....")
+                publish_to_mqtt(DOOR_TOPIC[set_door], door_payload(position, state), retain=True)
             return resp, position, state
         except Exception as ex:
             log.error(f"ERROR: {ex}")
@@ -194,89 +285,110 @@ def get_door_status(set_door):
                 break
             if CLI.last_error and retries < 5:
                 log.error(f"[ERROR] CLI error found {CLI.last_error}")  # TODO!!!
-                time.sleep(.8)
+                time.sleep(backoff_delay(retries))
                 retries += 1
             else:
                 break
     return None, -1, None
 
 
-def track_realtime_door_position(current_pos=None, last_action=None, set_door=0):
-    publish_to_mqtt(f"garage_door/{set_door}/position", current_pos)
+def track_door_position(set_door, current_pos=None, last_action=None):
+    # Hand the door over to the poller thread; replaces any tracking still running for it
+    last_state = LAST_DOOR_STATES.get(set_door)
+    publish_to_mqtt(DOOR_TOPIC[set_door], door_payload(current_pos, last_state), retain=True)
+    with TRACKED_DOORS_LOCK:
+        TRACKED_DOORS[set_door] = {"last_action": last_action, "pos": current_pos, "last_pos": None, "state": "",
+                                   "stalled": 0, "published": (current_pos, last_state)}
+    POLLER_WAKE.set()
 
-    global LAST_DOOR_STATE
-    global DO_EXIT_THREAD
 
-    state = ""
-    last_pos = None
+def update_door_position(set_door, track):
+    # Polls one tracked door and publishes any change; returns False once the door has stopped moving
+    track["last_pos"] = last_pos = track["pos"]
+    resp, current_pos, state = get_door_status(set_door, publish=False)
+    if resp is None:
+        return False
+    if not check_mcp_error(resp):
+        if current_pos < last_pos:
+            state = "closing"
+        elif current_pos > last_pos:
+            state = "opening"
+        elif current_pos == 100:
+            state = "open"
+        elif current_pos == 0:
+            state = "closed"
+        else:
+            state = "unknown"
+        LAST_DOOR_STATES[set_door] = state
+        if (current_pos, state) != track["published"]:
+            publish_to_mqtt(DOOR_TOPIC[set_door], door_payload(current_pos, state), retain=True)
+            track["published"] = (current_pos, state)
+    track["pos"] = current_pos
+    track["state"] = state
+    # A door stopped part-way (obstruction, wall button) never reaches open/closed, so give up after a while
+    track["stalled"] = track["stalled"] + 1 if current_pos == last_pos else 0
+    if track["stalled"] >= MAX_STALLED_POLLS:
+        log.info(f"Door {set_door} position unchanged for {MAX_STALLED_POLLS} polls, stopping tracking")
+        return False
+    last_action = track["last_action"]
+    return ((state != "open" and last_action in _UP_ACTIONS) or (
+            state != "closed" and last_action in _DOWN_ACTIONS) or current_pos != last_pos)
 
-    DO_EXIT_THREAD = False
-    while not DO_EXIT_THREAD and ((state != "open" and last_action == "up open") or (
-            state != "closed" and last_action in "down close") or current_pos != last_pos):
-        time.sleep(2)
-        last_pos = current_pos
-        resp, current_pos, state = get_door_status(set_door)
-        if resp is None:
-            DO_EXIT_THREAD = True
-            break
-        if not check_mcp_error(resp):
-            if current_pos < last_pos:
-                state = "closing"
-            elif current_pos > last_pos:
-                state = "opening"
-            elif current_pos == 100:
-                state = "open"
-            elif current_pos == 0:
-                state = "closed"
-            else:
-                state = "unknown"
-            LAST_DOOR_STATE = state
-            publish_to_mqtt(f"garage_door/{set_door}/position", current_pos)
-            publish_to_mqtt(f"garage_door/{set_door}/state", state)
-    LAST_DOOR_STATE = state
-    return LAST_DOOR_STATE
+
+def poll_door_positions():
+    # Single poller for all moving doors: one wake-up per POLL_INTERVAL covers every tracked port
+    try:
+        while not SHUTDOWN_EVENT.is_set():
+            with TRACKED_DOORS_LOCK:
+                idle = not TRACKED_DOORS
+            if idle:
+                POLLER_WAKE.wait()
+                POLLER_WAKE.clear()
+                continue
+            if SHUTDOWN_EVENT.wait(POLL_INTERVAL):
+                break
+            with TRACKED_DOORS_LOCK:
+                tracked = list(TRACKED_DOORS.items())
+            for set_door, track in tracked:
+                try:
+                    with CLI_LOCK:
+                        moving = update_door_position(set_door, track)
+                except Exception as ex:
+                    log.error(f"ERROR: tracking door {set_door} failed: {ex}")
+                    traceback.print_exc()
+                    moving = False
+                if not moving:
+                    with TRACKED_DOORS_LOCK:
+                        if TRACKED_DOORS.get(set_door) is track:
+                            del TRACKED_DOORS[set_door]
+                            LAST_DOOR_STATES[set_door] = track["state"]
+    except BaseException as ex:
+        request_shutdown(ex)
 
 
 def do_door_action(action, set_door):
-    global LAST_DOOR_STATE
     value = None
     if action == "stop":
-        if LAST_DOOR_STATE == "opening":
+        last_state = LAST_DOOR_STATES.get(int(set_door))
+        if last_state == "opening":
             action = "down"
-        elif LAST_DOOR_STATE == "closing":
+        elif last_state == "closing":
             action = "up"
         else:
-            log_msg = f"Ignoring 'stop' command as current door movement direction unknown (LAST_DOOR_STATE is '{LAST_DOOR_STATE}')"
+            log_msg = f"Ignoring 'stop' command as door {set_door} movement direction unknown (last state is '{last_state}')"
             log.warning(log_msg)
             return log_msg
 
-    if action in "impulse up down partial light stop":
+    if action in _SET_STATE_ACTIONS:
         try:
             port = int(set_door)
-            mcp_cmd = MCPSetState.construct(port)
+            mcp_cmd = _MCP_SET_STATE[port]
             action_resp = CLI.generic(mcp_cmd, False)
             if not check_mcp_error(action_resp):
                 current_pos = action_resp.payload.command.percent_open if hasattr(action_resp.payload.command,
                                                                                   "percent_open") else -1
-                global POS_TRACKING_THREAD
-                if POS_TRACKING_THREAD and POS_TRACKING_THREAD.is_alive():
-                    global DO_EXIT_THREAD
-                    DO_EXIT_THREAD = True
-                    time.sleep(0.1)
-                    counter = 0
-                    log.debug(f"...Active thread count: {threading.activeCount()} ")
-                    while POS_TRACKING_THREAD.is_alive() and counter < 15:
-                        log.debug(f"\t----> WAITING .... POS_TRACKING_THREAD.is_alive: {POS_TRACKING_THREAD.is_alive()}")
-                        time.sleep(.5)
-                        counter += 0.5
-                if POS_TRACKING_THREAD: log.debug(f"----> POS_TRACKING_THREAD.is_alive: {POS_TRACKING_THREAD.is_alive()}")
-                POS_TRACKING_THREAD = threading.Thread(
-                    name='pos_tracking_thread',
-                    target=track_realtime_door_position,
-                    args=(current_pos, action, set_door)
-                )
-                POS_TRACKING_THREAD.start()
-                log.debug(f"New thread spawned for 'do_command': {POS_TRACKING_THREAD}")
+                track_door_position(port, current_pos, action)
+                log.debug(f"Tracking position of door {port} after '{action}'")
             return action_resp
         except Exception as ex:
             log.error(f"ERROR: {ex}")
@@ -289,97 +401,122 @@ def do_door_action(action, set_door):
 
 
 def do_gw_login():
-    bisecur_user = config.get("bisecur_user")
-    bisecur_pw = config.get("bisecur_pw")
-    log.debug(f"INIT: Logging in to Bisecur Gateway as user '{bisecur_user}'")
-    CLI.login(bisecur_user, bisecur_pw)
+    log.debug(f"INIT: Logging in to Bisecur Gateway as user '{BISECUR_USER}'")
+    CLI.login(BISECUR_USER, BISECUR_PW)
     if CLI.token:
-        log.info(f"INIT: User '{bisecur_user}' logged in to Bisecur Gateway with token '{CLI.token}'")
+        log.info(f"INIT: User '{BISECUR_USER}' logged in to Bisecur Gateway with token '{CLI.token}'")
         return CLI.token
     else:
-        log.warning(f"INIT: Bisecur Gateway login failed for user '{bisecur_user}'. Exiting...")
+        log.warning(f"INIT: Bisecur Gateway login failed for user '{BISECUR_USER}'. Exiting...")
         return None
 
 
 def check_mcp_error(resp):
+    global ERROR_PUBLISHED
     if CLI.last_error:  # TODO!!! Tidy up...
         log.error(f"--- 1. CLI.last_error: {CLI.last_error}")
-        if hasattr(resp, "payload") and hasattr(resp.payload, "command") and hasattr(resp.payload.command,
-                                                                                     "error_code"):
-            error_obj = {"error_code": resp.payload.command.error_code.value,
-                         "error": resp.payload.command.error_code.name}
-        else:
+        try:
+            error_code = resp.payload.command.error_code
+            error_obj = {"error_code": error_code.value, "error": error_code.name}
+        except AttributeError:
             error_obj = {"error_code": "Unknown", "error": str(resp) if resp else "Unknown error"}
-        publish_to_mqtt(f"{MQTT_COMMAND_SUBTOPIC}/error", json.dumps(error_obj))
+        publish_to_mqtt(ERROR_TOPIC, error_obj)
+        ERROR_PUBLISHED = True
+        return None
+
+    try:
+        error_code = resp.payload.command.error_code if resp.payload.command_id == 1 else None
+    except AttributeError:
+        error_code = None
 
-    elif resp and hasattr(resp, "resp.payload") and hasattr(resp,
-                                                            "resp.payload.command_id") and resp.payload.command_id == 1 and hasattr(
-        resp.payload.command, "error_code"):
-        log.error(
-            f"MCP error '{resp.payload.command.error_code.value}' occurred (code: {resp.payload.command.error_code.name}) ")
+    if error_code is not None:
+        log.error(f"MCP error '{error_code.value}' occurred (code: {error_code.name}) ")
         # Error 12 is Permission Denied
         log.error(f"--- 2. CLI.last_error: {CLI.last_error}")
-        error_obj = {"error_code": resp.payload.command.error_code.value, "error": resp.payload.command.error_code.name}
-        publish_to_mqtt(f"{MQTT_COMMAND_SUBTOPIC}/error", json.dumps(error_obj))
+        error_obj = {"error_code": error_code.value, "error": error_code.name}
+        publish_to_mqtt(ERROR_TOPIC, error_obj)
+        ERROR_PUBLISHED = True
         return error_obj
 
-    else:
-        publish_to_mqtt(f"{MQTT_COMMAND_SUBTOPIC}/error", "")
-        return None
+    # Only clear the error topic once, not on every successful poll
+    if ERROR_PUBLISHED:
+        publish_to_mqtt(ERROR_TOPIC, "")
+        ERROR_PUBLISHED = False
+    return None
+
+
+def request_shutdown(ex):
+    # A SystemExit (e.g. failed gateway re-login) or crash in a helper thread must still stop the process
+    global EXIT_CODE
+    EXIT_CODE = ex.code if isinstance(ex, SystemExit) else 1
+    log.error(f"Thread '{threading.current_thread().name}' stopped ({ex!r}). Shutting down...")
+    SHUTDOWN_EVENT.set()
+
+
+def process_commands():
+    # Runs gateway I/O off the MQTT network thread; a None item stops the worker
+    try:
+        while True:
+            item = CMD_QUEUE.get()
+            if item is None:
+                break
+            func, args = item
+            with CLI_LOCK:
+                func(*args)
+    except BaseException as ex:
+        request_shutdown(ex)
 
 
 def on_message(mosq, userdata, msg):
     log.info(f"---> Topic '{msg.topic}' received command '{msg.payload.decode('utf-8')}'")
     cmd = msg.payload.decode('utf-8')
-    parts = cmd.split("_")
-    if re.match(r"^[a-zA-Z]+_\d+$", cmd):
-        log.info(f"Door: {parts[1]} and Command: {parts[0]}")
-        do_command(parts[0], parts[1])
-    else:
+    m = _CMD_RE.match(cmd)
+    if not m:
         log.warning(f"Received invalid command format: {cmd}")
+        return
+    set_door = int(m.group(2))
+    if set_door not in DOORS_PORT:
+        log.warning(f"Ignoring command '{cmd}' for unknown door {set_door} (configured: {DOORS_PORT})")
+        return
+    log.info(f"Door: {set_door} and Command: {m.group(1)}")
+    CMD_QUEUE.put((do_command, (m.group(1), set_door)))
 
 
 def on_connect(mosq, userdata, flags, result_code):
-    sub_topic = f"{MQTT_TOPIC_BASE}/{MQTT_COMMAND_SUBTOPIC}/command"
-    log.info(f"Connected to MQTT broker. Subscribing to '{sub_topic}'")
-    MQTT_CLIENT_SUB.subscribe(sub_topic, MQTT_QOS)
+    log.info(f"Connected to MQTT broker. Subscribing to '{COMMAND_TOPIC}'")
+    MQTT_CLIENT.subscribe(COMMAND_TOPIC, MQTT_SUB_QOS)
     for set_door in DOORS_PORT:
-        publish_to_mqtt(f"{set_door}/state", "online")
-        init_ha_discovery(set_door)
+        publish_to_mqtt(AVAILABILITY_TOPIC[set_door], "online", qos=MQTT_AVAILABILITY_QOS, with_ts=False)
+    # The gateway version query is gateway I/O, so leave it to the command worker
+    CMD_QUEUE.put((announce_device, ()))
+
+
+def announce_device():
+    gw_version = get_gw_version()
+    gw_hw_version = gw_version[1] if gw_version else None
+    for set_door in DOORS_PORT:
+        init_ha_discovery(set_door, gw_hw_version)
+    publish_to_mqtt(f"{MQTT_TOPIC_BASE}/attributes/system_version", VERSION)
+    publish_to_mqtt(f"{MQTT_TOPIC_BASE}/attributes/gw_ip_address", BISECUR_IP)
+    publish_to_mqtt(f"{MQTT_TOPIC_BASE}/attributes/gw_mac_address", BISECUR_MAC)
 
 
 def on_disconnect(mosq, userdata, rc):
     log.info("MQTT session disconnected")
     for set_door in DOORS_PORT:
-        publish_to_mqtt(f"{set_door}/state", "offline")
+        publish_to_mqtt(AVAILABILITY_TOPIC[set_door], "offline", qos=MQTT_AVAILABILITY_QOS, with_ts=False)
         log.info(f"Performing actions for port: {set_door}")
     time.sleep(10)
 
 
-def init_ha_discovery(set_door):
-    payload = {"door_commands_list": ["impulse", "up", "down", "partial", "stop", "light"],
-               "json_attributes_topic": f"{MQTT_TOPIC_BASE}/{set_door}/attributes",
-               "name": "Bisecur Gateway: Garage Door",
-               "schema": "state",
-               "supported_features": ["impulse", "up", "down", "partial", "stop", "light", "get_door_state",
-                                      "get_ports", "login", "sys_reset"],
-               "availability_topic": f"{MQTT_TOPIC_BASE}/{set_door}/state", "payload_available": "online",
-               "payload_not_available": "offline", "unique_id": "bs_garage_door", "device_class": "garage",
-               "payload_close": "down", "payload_open": "up", "payload_stop": "impulse", "position_open": 100.0,
-               "position_closed": 0.0, "position_topic": f"{MQTT_TOPIC_BASE}/{set_door}/garage_door/position",
-               "state_topic": f"{MQTT_TOPIC_BASE}/{set_door}/garage_door/state",
-               "command_topic": f"{MQTT_TOPIC_BASE}/{MQTT_COMMAND_SUBTOPIC}/command"}
-    bisecur_mac = config.get("bisecur_mac", "").replace(':', '')
-    bisecur_ip = config.get("bisecur_ip", None)
-    payload["connections"] = ["mac", bisecur_mac, "ip", bisecur_ip]
-    payload["sw_version"] = VERSION
-    _, payload["gw_hw_version"] = get_gw_version()
-
-    mqtt_topic_HA_discovery = config.get("mqtt_topic_HA_discovery", "homeassistant")
-    publish_to_mqtt(f"cover/bisecur/{set_door}/config", json.dumps(payload), f"{mqtt_topic_HA_discovery}")
-    publish_to_mqtt("attributes/system_version", VERSION)
-    publish_to_mqtt("attributes/gw_ip_address", bisecur_ip)
-    publish_to_mqtt("attributes/gw_mac_address", bisecur_mac)
+def init_ha_discovery(set_door, gw_hw_version=None):
+    payload = dict(HA_DISCOVERY_PAYLOAD,
+                   json_attributes_topic=ATTRIBUTES_TOPIC[set_door],
+                   availability_topic=AVAILABILITY_TOPIC[set_door],
+                   position_topic=DOOR_TOPIC[set_door],
+                   state_topic=DOOR_TOPIC[set_door],
+                   gw_hw_version=gw_hw_version)
+    publish_to_mqtt(HA_CONFIG_TOPIC[set_door], json_dumps(payload), with_ts=False)
 
 
 def init_bisecur_gw(is_restart=False):
@@ -388,14 +525,11 @@ def init_bisecur_gw(is_restart=False):
         CLI.logout()
 
     # Init Bisecur Gateway stuff
-    src_mac = config.get("src_mac", "FF:FF:FF:FF:FF:FF").replace(':', '')
-    bisecur_mac = config.get("bisecur_mac", "").replace(':', '')
-    bisecur_ip = config.get("bisecur_ip", None)
-    if not (bisecur_ip and bisecur_mac):
+    if not (BISECUR_IP and BISECUR_MAC):
         log.error("ERROR: bisecur Gateway IP and MAC addresses must be specified in the config file")
         sys.exit(2)
-    log.debug(f"INIT: Gateway IP: {bisecur_ip}, bisecur_mac: {bisecur_mac}, src_mac: {src_mac}")
-    CLI = MCPClient(bisecur_ip, 4000, bytes.fromhex(src_mac), bytes.fromhex(bisecur_mac))
+    log.debug(f"INIT: Gateway IP: {BISECUR_IP}, bisecur_mac: {BISECUR_MAC}, src_mac: {SRC_MAC}")
+    CLI = MCPClient(BISECUR_IP, 4000, bytes.fromhex(SRC_MAC), bytes.fromhex(BISECUR_MAC))
     login_token = do_gw_login()
     if not login_token:
         sys.exit(2)
@@ -403,32 +537,50 @@ def init_bisecur_gw(is_restart=False):
     return login_token
 
 
+_DISPATCH = {
+    "get_ports": get_ports,
+    "get_version": get_gw_version,
+    "get_gw_version": get_gw_version,
+    "login": do_gw_login,
+    "sys_restart": lambda: init_bisecur_gw(True),
+    "init_bisecur_gw": lambda: init_bisecur_gw(True),
+}
+
+
 if __name__ == '__main__':
     # Init mqtt
     userdata = {
     }
 
     clientid = config.get('mqtt_client_id', 'biscure2mqtt-{}'.format(os.getpid()))
-    MQTT_CLIENT_SUB = paho.Client(f"{clientid}_sub", clean_session=False)
-    MQTT_CLIENT_PUB = paho.Client(f"{clientid}_pub", clean_session=False)
+    MQTT_CLIENT = paho.Client(clientid, clean_session=False)
+    MQTT_CLIENT.max_inflight_messages_set(MQTT_MAX_INFLIGHT)
+    MQTT_CLIENT.max_queued_messages_set(MQTT_MAX_QUEUED)
 
     for set_door in DOORS_PORT:
-        MQTT_CLIENT_SUB.will_set(f"{MQTT_TOPIC_BASE}/{set_door}/state", "offline", qos=0)
+        MQTT_CLIENT.will_set(AVAILABILITY_TOPIC[set_door], "offline", qos=MQTT_AVAILABILITY_QOS)
 
-    MQTT_CLIENT_SUB.on_message = on_message
-    MQTT_CLIENT_SUB.on_connect = on_connect
-    MQTT_CLIENT_SUB.on_disconnect = on_disconnect
+    MQTT_CLIENT.on_message = on_message
+    MQTT_CLIENT.on_connect = on_connect
+    MQTT_CLIENT.on_disconnect = on_disconnect
 
     if config.get('mqtt_username') is not None:
-        MQTT_CLIENT_SUB.username_pw_set(config.get('mqtt_username'), config.get('mqtt_password'))
-        MQTT_CLIENT_PUB.username_pw_set(config.get('mqtt_username'), config.get('mqtt_password'))
+        MQTT_CLIENT.username_pw_set(config.get('mqtt_username'), config.get('mqtt_password'))
 
     if config.get('mqtt_tls') is not None:
-        MQTT_CLIENT_SUB.tls_set()
+        MQTT_CLIENT.tls_set()
 
-    MQTT_CLIENT_SUB.connect(config.get('mqtt_broker', 'localhost'), int(config.get('mqtt_port', '1883')), 60)
-    MQTT_CLIENT_PUB.connect(config.get('mqtt_broker', 'localhost'), int(config.get('mqtt_port', '1883')), 60)
     log.info("Connecting to MQTT broker")
+    retries = 0
+    while True:
+        try:
+            MQTT_CLIENT.connect(config.get('mqtt_broker', 'localhost'), int(config.get('mqtt_port', '1883')), 60)
+            break
+        except socket.error:
+            delay = backoff_delay(retries, base=5)
+            print(f"... doing sleep({delay:.1f})")
+            time.sleep(delay)
+            retries += 1
 
     # Init Bisecur Gateway
     init_bisecur_gw()
@@ -439,33 +591,43 @@ if __name__ == '__main__':
         CLI.jcmp(cmd)
     for set_door in DOORS_PORT:
         get_door_status(set_door)
-    while True:
-        try:
-            MQTT_CLIENT_SUB.loop_forever()
-        except socket.error:
-            print("... doing sleep(5)")
-            time.sleep(5)
-        except KeyboardInterrupt:
-            log.info("Shutting down connections")
-        finally:
-            log.info("Exiting system. Changing MQTT state to 'offline'")
-            for set_door in DOORS_PORT:
-                MQTT_CLIENT_PUB.publish(f"{MQTT_TOPIC_BASE}/{set_door}/state", "offline")
-            MQTT_CLIENT_SUB.loop_stop()
+
+    try:
+        # Non-daemon helper threads are started inside the try so the finally below always stops them
+        CMD_WORKER_THREAD = threading.Thread(name='cmd_worker_thread', target=process_commands)
+        CMD_WORKER_THREAD.start()
+        POLLER_THREAD = threading.Thread(name='door_poller_thread', target=poll_door_positions)
+        POLLER_THREAD.start()
+        MQTT_CLIENT.loop_start()
+        SHUTDOWN_EVENT.wait()
+    except KeyboardInterrupt:
+        log.info("Shutting down connections")
+    finally:
+        log.info("Exiting system. Changing MQTT state to 'offline'")
+        for set_door in DOORS_PORT:
+            MQTT_CLIENT.publish(AVAILABILITY_TOPIC[set_door], "offline", qos=MQTT_AVAILABILITY_QOS)
+        MQTT_CLIENT.loop_stop()
+        CMD_QUEUE.put(None)
+        SHUTDOWN_EVENT.set()
+        POLLER_WAKE.set()
+        with CLI_LOCK:
             if CLI:
                 if hasattr(CLI, "last_error") and CLI.last_error is not None and "value" in CLI.last_error and CLI.last_error.value == 12:
                     log.info(f"Logging out of Bisecur Gateway ({CLI.token})")
                     CLI.logout()
                 elif hasattr(CLI, "last_error"):
                     log.debug(f"Pre-logout: Biscure last error: ({CLI.last_error})")
-            log.info(f"Active threads: {threading.activeCount()}")
-            log.debug("Tidying up spawned threads...")
-            main_thread = threading.currentThread()
-            for t in threading.enumerate():
-                if t is main_thread:
-                    log.info(f"... ignoring main_thread '{main_thread.getName()}'")
-                    continue
-                log.info(f"...joining spawned thread '{t.getName()}'")
-                t.join()
-            log.info("Done!")
-            sys.exit(0)
+        log.info(f"Active threads: {threading.active_count()}")
+        log.debug("Tidying up spawned threads...")
+        main_thread = threading.main_thread()
+        for t in threading.enumerate():
+            if t is main_thread:
+                log.info(f"... ignoring main_thread '{main_thread.name}'")
+                continue
+            if t.daemon:
+                log.info(f"... ignoring daemon thread '{t.name}'")
+                continue
+            log.info(f"...joining spawned thread '{t.name}'")
+            t.join()
+        log.info("Done!")
+        sys.exit(EXIT_CODE)